@@ -15,17 +15,73 @@
 # limitations under the License.
 
 import argparse
+import collections
+import concurrent.futures
 import datetime
 import docker
+import functools
+import hashlib
+import itertools
 import json
 import os
 import pathlib
+import re
+import shlex
 import shutil
 import subprocess
 import sys
+import threading
 
 import fs.tempfs
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl request number to reflink a file on linux, only exported by fcntl from python 3.12 on
+FICLONE = 0x40049409
+
+# only patches and copied files are needed in the build context
+DOCKERIGNORE = b"""\
+*
+!*.patch
+!copy-*
+"""
+
+# authors are taken from the patches, but git am also needs a committer identity
+GIT_AM = 'git -c user.name=docker-image-patch -c user.email=docker-image-patch@localhost am --keep-non-patch'
+
+# git output is parsed or applied, not read - skip locale lookups and translations
+GIT_ENV = {**os.environ, 'LC_ALL': 'C'}
+
+# concurrent git processes, git diff is mostly bound by I/O but can use a core each on large diffs
+GIT_WORKERS = min(8, os.cpu_count() or 1)
+
+# tmpfs mount available on (nearly) all linux systems, used for the build context if it has space
+SHM_DIR = '/dev/shm'
+
+# free space /dev/shm needs on top of the known context size, as the size of git diffs is unknown
+# up front. Also keeps the small /dev/shm of containers (64 MiB by default) from being used
+SHM_HEADROOM = 512 * 1024 * 1024
+
+
+class _OrderedPatchAction(argparse.Action):
+    """Append (const, values) to the destination list, so options sharing it keep their relative order"""
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        items = getattr(namespace, self.dest)
+        if items is parser.get_default(self.dest):
+            # copy the default once instead of on every call, it must not be modified
+            items = list(items)
+            setattr(namespace, self.dest, items)
+        items.append((self.const, values))
+
 
 def _parser():
     parser = argparse.ArgumentParser()
@@ -51,24 +107,55 @@ def _parser():
                              'and commands. Items will be copied to a temporary directory before build is run. '
                              'Can be specified multiple times')
 
-    # patches
-    parser.add_argument('-g', '--git', metavar='[[path/to/git] git-ref] <docker-workdir>]',
-                        nargs='+', action='append', default=[],
+    # patches - both options share one list to keep the order they were specified in
+    parser.add_argument('-g', '--git', metavar='[[path/to/git] git-ref] <docker-workdir>] [pathspec ...]',
+                        nargs='+', action=_OrderedPatchAction, const='git', dest='patch_order', default=[],
                         help='Generate a patch from git. Has 1-3 arguments. The first (optional) argument is '
                              'the path to the git, defaults to cwd. The second (optional) is the git-ref, e.g. '
                              'a commit hash, defaults to HEAD. The third (required) argument is the path '
-                             'inside the docker image where the patch command will be executed.')
+                             'inside the docker image where the patch command will be executed. If all three '
+                             'are given, any further arguments are git pathspecs (relative to the git path) '
+                             'limiting the diff, e.g. a subdirectory of a large repository.')
     parser.add_argument('-p', '--patch', metavar='<path/to/patch> [path/to/patch ...] <docker-workdir>',
-                        nargs='+', action='append', default=[],
+                        nargs='+', action=_OrderedPatchAction, const='patch', dest='patch_order', default=[],
                         help='Similar to --git, but uses a pregenerated patch file')
+    parser.add_argument('--git-am', default=False, action='store_true',
+                        help='Export --git commit ranges (git-ref A..B) with git format-patch and apply them '
+                             'with git am, keeping the individual commits. The docker workdir of these patches '
+                             'needs to be a git repository. Symmetric ranges (A...B) are still applied as diff')
 
     # docker build args
+    parser.add_argument("--backend", default='docker', choices=('docker', 'ch-image'),
+                        help="Image builder to use. docker builds with BuildKit via docker buildx, ch-image builds "
+                             "with Charliecloud, whose git based build cache scales with the size of changes "
+                             "instead of the number of instructions (default: docker)")
     parser.add_argument("--no-cache", default=False, action="store_true",
                         help="Disable caching of docker image layers")
     parser.add_argument("--network", default=None,
                         help="Set docker networking mode passed to docker build")
+    parser.add_argument("--build-context-dir", default=None, metavar='DIR',
+                        help="Directory to create the temporary build context in. Defaults to /dev/shm if "
+                             "it has enough space and no --copy sources live elsewhere, otherwise to the "
+                             "system temp directory")
+    parser.add_argument("--cache-from", default=[], nargs='*', metavar='REF',
+                        help="External cache sources passed to docker buildx build, e.g. a previously pushed "
+                             "image or type=registry,ref=<image>")
+    parser.add_argument("--cache-to", default=None, metavar='DEST',
+                        help="Cache export destination passed to docker buildx build, e.g. type=inline")
+    parser.add_argument("--inline-cache", default=False, action="store_true",
+                        help="Embed build cache metadata into the image and use the image's own tags as cache "
+                             "sources, so pushed builds speed up later builds of the same repository")
 
     # other
+    parser.add_argument('--precheck', default=False, action='store_true',
+                        help='Verify that all --patch files are well-formed patches before pulling the base image '
+                             'and building, to fail early on broken patch files')
+    parser.add_argument('--pull', default='missing', choices=('always', 'missing', 'never'),
+                        help='When to pull the base image: always, only if it is not present locally (default) '
+                             'or never. Set DIP_REGISTRY_MIRROR to pull images without an explicit registry '
+                             'from a registry mirror')
+    parser.add_argument('--always-pull', dest='pull', action='store_const', const='always',
+                        help='Same as --pull always')
     parser.add_argument('--push-image', default=False, action="store_true",
                         help="Push the image after a successfull build")
     parser.add_argument('-q', '--quiet', default=False, action='store_true', help='Be a little more quiet')
@@ -78,245 +165,644 @@ def _parser():
     return parser
 
 
+def _run_instruction(commands):
+    """Dockerfile RUN instruction executing all commands in one layer, stopping at the first failure
+
+    The commands end up on a single shell line, so a comment in one of them would swallow all
+    following commands. Commands that might contain one are run through eval to confine it.
+    """
+    commands = ["eval " + shlex.quote(command) if '#' in command else command for command in commands]
+    separator = " && \\\n    "
+    return f"RUN {separator.join(commands)}"
+
+
+@functools.lru_cache(maxsize=None)
+def _abs_path(path):
+    """Resolved absolute path, cached as most --git options share the same path"""
+    return str(pathlib.Path(path).resolve())
+
+
+def _resolve_refs(git_bin, git_path, refs):
+    """Resolve git refs to object names using one git cat-file process
+
+    Both ends of ref ranges are resolved, an empty end is resolved as HEAD. Returns a
+    dict mapping each ref to its resolved form, or to None if it could not be resolved.
+    """
+    revisions = {}
+    for ref in refs:
+        for revision in re.split(r'\.{2,3}', ref):
+            revisions[revision or 'HEAD'] = None
+
+    cmd = [git_bin, '-C', git_path, 'cat-file', '--batch-check=%(objectname)']
+    output = subprocess.run(cmd, input=''.join(revision + '\n' for revision in revisions),
+                            stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    # unresolvable revisions are answered with "<revision> missing" (or "ambiguous")
+    for revision, line in zip(list(revisions), output.splitlines()):
+        if re.fullmatch(r'[0-9a-f]{40,64}', line):
+            revisions[revision] = line
+
+    resolved = {}
+    for ref in refs:
+        parts = re.split(r'(\.{2,3})', ref)
+        for n in range(0, len(parts), 2):
+            parts[n] = revisions[parts[n] or 'HEAD']
+        resolved[ref] = None if None in parts else ''.join(parts)
+    return resolved
+
+
+def _image_repository(image):
+    """Repository of an image reference, None if the reference has neither a tag nor a digest
+
+    The tag follows the last path component, a colon before that separates the registry port.
+    """
+    name, _, digest = image.partition('@')
+    repository, _, tag = name.rpartition(':')
+    if repository and '/' not in tag:
+        return repository
+    return name if digest else None
+
+
+def _base_image_defaults(image_info):
+    """User and workdir from the config of an image's inspect result
+
+    Images built from scratch may come without a config or with an empty workdir, which means /.
+    """
+    config = image_info.get('Config') or {}
+    return config.get('User', ''), config.get('WorkingDir') or '/'
+
+
+def _mirrored_image(image, mirror):
+    """Reference to image on the given registry mirror, images with an explicit registry are kept as they are"""
+    registry, _, path = image.partition('/')
+    if path and ('.' in registry or ':' in registry or registry == 'localhost'):
+        return image
+    if not path:
+        # official images live in the library namespace
+        image = 'library/' + image
+    return '{}/{}'.format(mirror.rstrip('/'), image)
+
+
+def _git_diff(git_bin, git_path, git_ref, pathspecs, mailbox, dest):
+    """Stream the diff of a git against a ref into dest, returns the size of the diff
+
+    The diff is limited to the given pathspecs or, if there are none, to the git path.
+    With mailbox set, the commits of the ref range are exported via git format-patch.
+    The output must be applicable as is, so colors, external diff drivers and textconv
+    filters configured by the user are disabled and binary changes are included.
+    """
+    cmd = [git_bin, '-C', git_path]
+    cmd.extend(['format-patch', '--stdout'] if mailbox else ['diff'])
+    cmd.extend(['--no-color', '--binary', '--no-ext-diff', '--no-textconv', git_ref, '--'])
+    cmd.extend(pathspecs or [_abs_path(git_path)])
+    with open(dest, 'wb') as f, subprocess.Popen(cmd, stdout=subprocess.PIPE, env=GIT_ENV) as proc:
+        shutil.copyfileobj(proc.stdout, f, length=1024 * 1024)
+        size = f.tell()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return size
+
+
+def _path_size(path):
+    """Size of a file or all files in a directory, 0 if it cannot be determined"""
+    path = pathlib.Path(path).expanduser()
+    try:
+        if path.is_dir():
+            return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+
+def _content_digest(path):
+    """Digest over the name, the relative paths and modes of all entries and the file contents of a file or tree"""
+    path = pathlib.Path(path).expanduser()
+    digest = hashlib.blake2b(path.name.encode(), digest_size=16)
+
+    def update(entry):
+        entry_stat = entry.stat()
+        digest.update('\0{}\0{}\0{}\0'.format(entry.relative_to(path), entry_stat.st_mode,
+                                               entry_stat.st_size).encode())
+        if entry.is_file():
+            with open(entry, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+
+    if path.is_dir():
+        # follow symlinks like shutil.copytree() does when staging the tree
+        for root, dirs, files in os.walk(path, followlinks=True):
+            dirs.sort()
+            root = pathlib.Path(root)
+            update(root)
+            for name in sorted(files):
+                update(root / name)
+    else:
+        update(path)
+    return digest.hexdigest()
+
+
+def _memory_context_dir(context_size, copy_sources=()):
+    """Return /dev/shm if it has room for twice the given size and some headroom, None (system temp dir) otherwise
+
+    Files to copy are hardlinked into the build context, which only works on the same filesystem.
+    Unless they already are on /dev/shm, they would be copied into memory, so it is not used then.
+    """
+    try:
+        shm = os.statvfs(SHM_DIR)
+        shm_device = os.stat(SHM_DIR).st_dev
+        if any(os.stat(pathlib.Path(src).expanduser()).st_dev != shm_device for src in copy_sources):
+            return None
+    except (OSError, AttributeError):
+        return None
+    if os.access(SHM_DIR, os.W_OK) and shm.f_bavail * shm.f_bsize > 2 * context_size + SHM_HEADROOM:
+        return SHM_DIR
+    return None
+
+
+def _fast_copy(src, dst):
+    """Copy a file with its metadata, preferring a reflink or an in-kernel copy
+
+    Falls back to a regular copy with a large buffer if neither is supported
+    by the platform or filesystem.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        copied = False
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), getattr(fcntl, 'FICLONE', FICLONE), fsrc.fileno())
+                copied = True
+            except OSError:
+                pass
+
+        if not copied and hasattr(os, 'copy_file_range'):
+            # copy_file_range() advances both file offsets, so a fallback continues where it failed
+            try:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                    pass
+                copied = True
+            except OSError:
+                pass
+
+        if not copied:
+            shutil.copyfileobj(fsrc, fdst, length=1024 * 1024)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def _link_or_copy(src, dst):
+    """Hardlink src to dst, copy it if that is not possible (e.g. dst is on another filesystem)"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        _fast_copy(src, dst)
+    return dst
+
+
 def main():
     parser = _parser()
     args = parser.parse_args()
 
     # verify correct amount of arguments for --git and --patch
-    for arg in args.git:
-        if len(arg) > 3:
-            parser.error('Wrong argument count for --git - must be <= 3 (for argument {})'
-                         ''.format(arg))
-
-    for arg in args.patch:
-        if len(arg) < 2:
+    for opt_type, arg in args.patch_order:
+        if opt_type == 'patch' and len(arg) < 2:
             parser.error('Wrong argument count for --patch - must be >= 2 (for argument {})'
                          ''.format(arg))
 
     # check if we're given any patches
-    if not (args.git or args.patch or args.run_before or args.run_after or args.copy):
+    if not (args.patch_order or args.run_before or args.run_after or args.copy):
         parser.error("Neither --git, --patch, --run-before, --run-after or --copy specified - nothing to do")
 
-    if ':' not in args.base_image:
+    # commands are chained on one line in the Dockerfile, where a newline would end the instruction
+    if any('\n' in command for command in args.run_before + args.run_after):
+        parser.error("Commands for --run-before and --run-after must not contain newlines")
+
+    base_repository = _image_repository(args.base_image)
+    if base_repository is None:
         parser.error("Please specify a tag for the base image")
 
+    if args.backend == 'ch-image':
+        if args.network or args.cache_from or args.cache_to or args.inline_cache:
+            parser.error("--network, --cache-from, --cache-to and --inline-cache are not supported by the "
+                         "ch-image backend")
+        if len(args.tags) + bool(args.tag_time) > 1:
+            parser.error("The ch-image backend supports only a single tag")
+
+    # git is looked up once, and only if patches need to be generated or checked with it
+    git_bin = None
+    if any(opt_type == 'git' for opt_type, _ in args.patch_order) or (args.precheck and args.patch_order):
+        git_bin = shutil.which('git')
+        if git_bin is None:
+            parser.error("git not found in PATH, it is required for --git and --precheck")
+
     if not args.repository:
-        args.repository = "".join(args.base_image.split(":")[:-1])
-
-    # as the order of the patches is quite important, we need to look
-    # into argv for the order of --patch / --git commands
-    git_flags = ('-g', '--git')
-    patch_flags = ('-p', '--patch')
-    git_patch_order = []
-    for arg in sys.argv:
-        if arg in git_flags:
-            git_patch_order.append('git')
-        elif arg in patch_flags:
-            git_patch_order.append('patch')
-
-    # create docker filesystem
-    dockerfs = fs.tempfs.TempFS("docker-live-patch", auto_clean=False)
-
-    # generate patchset
-    def add_patch(patch_count, name, diff):
-        patch_path = "{:04d}-{}{}".format(patch_count, name, '' if name.endswith('.patch') else '.patch')
-        dockerfs.settext('/' + patch_path, diff)
-        patches.append((patch_path, opt[-1]))
-
-    patches = []
-    patch_count = 0
-    for n, opt_type in enumerate(git_patch_order):
-        if opt_type == 'git':
-            opt = args.git.pop(0)
-            git_path, git_ref = '.', 'HEAD'
-            if len(opt) == 2:
-                git_ref = opt[0]
-            elif len(opt) == 3:
-                git_path, git_ref = opt[0:2]
-
-            name = git_ref
-            name = name.replace("/", "_")
-            if '..' not in name:
-                name += '-HEAD+staged'
+        args.repository = base_repository
 
+    # duplicate tags are dropped, keeping the order as the first tag is set by the build
+    time_tag = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    args.tags = list(dict.fromkeys(args.tags))
+    if not args.tags or (args.tag_time and time_tag not in args.tags):
+        args.tags.append(time_tag)
+    fq_tags = [f"{args.repository}:{tag}" for tag in args.tags]
+
+    # the target repository defaults to the original name, only the base image is taken from the mirror
+    if os.environ.get('DIP_REGISTRY_MIRROR'):
+        args.base_image = _mirrored_image(args.base_image, os.environ['DIP_REGISTRY_MIRROR'])
+
+    # one docker client, and with it one connection to the daemon, is used for pull, tagging
+    # and push. The timeout is raised as pulling or pushing large images can take a while
+    client = None
+    if args.backend == 'docker':
+        try:
+            client = docker.from_env(timeout=600)
+        except Exception as e:
+            print(f"Error: Could not reach docker daemon - is it running? Error was: {e}")
+            sys.exit(1)
+
+    # create docker filesystem, preferably in memory
+    copy_sizes = [_path_size(copy_from) for copy_from, _ in args.copy]
+    context_dir = args.build_context_dir
+    if context_dir is None:
+        context_size = sum(copy_sizes)
+        context_size += sum(_path_size(path) for opt_type, opt in args.patch_order if opt_type == 'patch'
+                            for path in opt[:-1])
+        context_dir = _memory_context_dir(context_size, [copy_from for copy_from, _ in args.copy])
+    dockerfs = fs.tempfs.TempFS("docker-live-patch", temp_dir=context_dir, auto_clean=False)
+    ctx_root = pathlib.Path(dockerfs.getsyspath(''))
+
+    # the build context is removed on every exit but a failed build, which leaves it for inspection
+    keep_context = False
+    try:
+        # collect patch sources in the order they have been specified
+        patch_sources = []
+        for opt_type, opt in args.patch_order:
+            if opt_type == 'git':
+                git_path, git_ref, workdir, pathspecs = '.', 'HEAD', opt[-1], ()
+                if len(opt) == 2:
+                    git_ref = opt[0]
+                elif len(opt) >= 3:
+                    git_path, git_ref, workdir = opt[0:3]
+                    pathspecs = tuple(opt[3:])
+
+                name = git_ref
+                name = name.replace("/", "_")
+                if '..' not in name:
+                    name += '-HEAD+staged'
+
+                # format-patch would export the commits of both sides of a symmetric range A...B,
+                # while git diff only shows the changes on B since the merge base
+                mailbox = args.git_am and '..' in git_ref and '...' not in git_ref
+                patch_sources.append(('git', name, workdir, (git_path, git_ref, pathspecs, mailbox)))
+            else:
+                for path in opt[:-1]:
+                    patch_sources.append(('patch', os.path.basename(path), opt[-1], path))
+
+        # resolve the refs of all --git options with a single git process per git, all gits concurrently.
+        # Resolved refs are only used to find identical diffs, refs that cat-file does not understand
+        # (e.g. HEAD^!) are passed to git diff as they are, which then decides whether they are valid.
+        # A git with a single distinct ref has nothing to dedupe, the ref itself is used without resolving
+        git_refs = collections.defaultdict(dict)
+        for source_type, name, workdir, source in patch_sources:
+            if source_type == 'git':
+                git_refs[source[0]][source[1]] = None
+        resolved_refs = {}
+        for git_path, refs in list(git_refs.items()):
+            if len(refs) < 2:
+                resolved_refs.update(((git_path, ref), ref) for ref in refs)
+                del git_refs[git_path]
+        resolve_futures = {}
+        if git_refs:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(GIT_WORKERS, len(git_refs))) as executor:
+                for git_path, refs in git_refs.items():
+                    resolve_futures[git_path] = executor.submit(_resolve_refs, git_bin, git_path, list(refs))
+        for git_path, future in resolve_futures.items():
             try:
-                git_abs_path = str(pathlib.Path(git_path).resolve())
-                diff = subprocess.check_output(['git', '-C', git_path, 'diff', git_ref, '--', git_abs_path]).decode()
+                resolved = future.result()
             except subprocess.CalledProcessError as e:
-                print('Error: Could not acquire git diff for git "{}" ({}) - is the git path correct?'
+                print('Error: Could not resolve refs for git "{}" ({}) - is the git path correct?'
                       ''.format(git_path, e),
                       file=sys.stderr)
                 sys.exit(1)
+            for ref, resolved_ref in resolved.items():
+                resolved_refs[git_path, ref] = resolved_ref or ref
+
+        # generate patchset - git diffs are streamed and patch files are copied to the
+        # docker filesystem concurrently, patch numbering follows the original order.
+        # Diffs of the same git, resolved ref and pathspecs are only generated once and hardlinked.
+        patches = []
+        if patch_sources:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(GIT_WORKERS, len(patch_sources))) as executor:
+                futures = []
+                generated = {}
+                links = []
+                for patch_count, (source_type, name, workdir, source) in enumerate(patch_sources):
+                    suffix = '' if name.endswith('.patch') else '.patch'
+                    patch_path = f"{patch_count:04d}-{name}{suffix}"
+                    dest = ctx_root / patch_path
+                    if source_type == 'git':
+                        git_path, git_ref, pathspecs, mailbox = source
+                        diff_key = (_abs_path(git_path), resolved_refs[git_path, git_ref], pathspecs, mailbox)
+                        if diff_key in generated:
+                            future, first_dest = generated[diff_key]
+                            links.append((first_dest, dest))
+                        else:
+                            future = executor.submit(_git_diff, git_bin, git_path, diff_key[1], pathspecs, mailbox,
+                                                     dest)
+                            generated[diff_key] = future, dest
+                    else:
+                        future = executor.submit(_fast_copy, source, dest)
+                    futures.append(future)
+                    patches.append((patch_path, workdir, source_type == 'git' and source[3]))
+
+                # check results as they complete, so a failing patch aborts without waiting for the others
+                future_sources = {}
+                for (source_type, name, workdir, source), future in zip(patch_sources, futures):
+                    future_sources.setdefault(future, (source_type, source))
+                for future in concurrent.futures.as_completed(future_sources):
+                    source_type, source = future_sources[future]
+                    error = None
+                    try:
+                        result = future.result()
+                    except subprocess.CalledProcessError as e:
+                        error = ('Error: Could not acquire git diff for git "{}" ({}) - is the git path correct?'
+                                 ''.format(source[0], e))
+                    except OSError as e:
+                        if source_type == 'git':
+                            error = 'Error: Could not write git diff for git "{}" ({})'.format(source[0], e)
+                        else:
+                            error = 'Error: Could not read patch {} ({})'.format(source, e)
+                    else:
+                        # for git sources the result is the size of the diff
+                        if source_type == 'git' and not result:
+                            error = 'Error: Diff for git "{}" ref {} is empty!'.format(source[0], source[1])
+                    if error:
+                        for pending in futures:
+                            pending.cancel()
+                        print(error, file=sys.stderr)
+                        sys.exit(1)
+
+                for first_dest, dest in links:
+                    os.link(first_dest, dest)
+
+        if args.precheck:
+            # only the patches themselves are parsed, the files they change are inside the image. Diffs
+            # generated from a git are well-formed, so only pregenerated patch files need to be checked
+            for (source_type, name, workdir, source), (patch_path, _, _) in zip(patch_sources, patches):
+                if source_type != 'patch':
+                    continue
+                result = subprocess.run([git_bin, 'apply', '--numstat', patch_path], cwd=str(ctx_root), env=GIT_ENV,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+                if result.returncode != 0:
+                    print('Error: Patch {} is not a valid patch: {}'.format(source, result.stderr.strip()),
+                          file=sys.stderr)
+                    sys.exit(1)
+
+        copy_files = []
+        if args.copy:
+            # copy files to dockerfs - sources are staged only once and hardlinked afterwards. The same
+            # source is recognized by its inode. Sources on the filesystem of the context are hardlinked
+            # anyway, others are hashed to find identical content if they share their size with another source
+            staged = {}
+            size_counts = collections.Counter(copy_sizes)
+            ctx_device = ctx_root.stat().st_dev
+            for n, (copy_from, copy_to) in enumerate(args.copy):
+                print("Copying {} to docker tempfs".format(copy_from))
+                copy_from = pathlib.Path(copy_from).expanduser()
+                dest_dir = pathlib.Path(f"copy-{n:08d}")
+                dockerfs.makedir(dest_dir.name)
+                dest_path = ctx_root / dest_dir / copy_from.name
+                copy_stat = copy_from.stat()
+                keys = [(copy_stat.st_dev, copy_stat.st_ino)]
+                if keys[0] not in staged and copy_stat.st_dev != ctx_device and size_counts[copy_sizes[n]] > 1:
+                    keys.append(_content_digest(copy_from))
+                staged_path = next((staged[key] for key in keys if key in staged), None)
+                if staged_path is not None and copy_from.is_dir():
+                    shutil.copytree(staged_path, dest_path, copy_function=os.link)
+                elif staged_path is not None:
+                    os.link(staged_path, dest_path)
+                elif copy_from.is_dir():
+                    shutil.copytree(copy_from, dest_path, copy_function=_link_or_copy)
+                else:
+                    _link_or_copy(copy_from, dest_path)
+                for key in keys:
+                    staged.setdefault(key, dest_path)
+                copy_files.append((str(dest_dir / copy_from.name), copy_to))
+
+        # fetch original values from the base image config, pulling it only if not present locally
+        # ch-image pulls the base image itself and runs the build as root, so nothing needs to be restored
+        orig_user, orig_workdir = '', None
+        if args.backend == 'docker':
+            base_image_info = None
+            if args.pull != 'always':
+                try:
+                    base_image_info = client.api.inspect_image(args.base_image)
+                except docker.errors.ImageNotFound:
+                    if args.pull == 'never':
+                        print("Error: Base image {} is not present locally and --pull is never"
+                              "".format(args.base_image), file=sys.stderr)
+                        sys.exit(1)
+            if base_image_info is None:
+                if not args.quiet:
+                    print("Pulling {} ...".format(args.base_image))
+                # stream the pull, errors after the pull has started are only reported in the stream
+                repository, tag = docker.utils.parse_repository_tag(args.base_image)
+                pull_error = None
+                try:
+                    for progress in client.api.pull(repository, tag, stream=True, decode=True):
+                        pull_error = progress.get('error', pull_error)
+                except docker.errors.NotFound as e:
+                    pull_error = e
+                if pull_error:
+                    print("Error: Could not pull base image - {}".format(pull_error), file=sys.stderr)
+                    sys.exit(1)
+                base_image_info = client.api.inspect_image(args.base_image)
+
+            orig_user, orig_workdir = _base_image_defaults(base_image_info)
+
+        # write docker file, lines are encoded as they are emitted
+        dockerfile = bytearray()
+
+        def emit(line=''):
+            dockerfile.extend(line.encode())
+            dockerfile.append(0x0a)
+
+        emit(f"FROM {args.base_image}")
+        if args.backend == 'docker':
+            emit("USER root")
+        emit()
+
+        if copy_files:
+            emit("# Files or directories to copy into the image")
+            for copy_from, copy_to in copy_files:
+                emit(f"COPY {json.dumps([copy_from, copy_to])}")
+            emit()
+
+        if args.run_before:
+            emit("# Commands to run before patching")
+            emit(_run_instruction(args.run_before))
+            emit()
+
+        if patches:
+            # all patches are copied and applied in one step each to keep the layer count constant,
+            # patch files are the only *.patch files in the top level of the docker filesystem.
+            # Consecutive patches for the same workdir share one cd, patches are never reordered
+            patch_commands = []
+            for patch_workdir, workdir_patches in itertools.groupby(patches, key=lambda patch: patch[1]):
+                patch_commands.append(f'mkdir -p "{patch_workdir}" && cd "{patch_workdir}"')
+                for patch_name, _, mailbox in workdir_patches:
+                    print("Adding patch", patch_name)
+                    if mailbox:
+                        patch_commands.append(f'{GIT_AM} "/patches/{patch_name}"')
+                    else:
+                        patch_commands.append(f'git apply --whitespace=nowarn "/patches/{patch_name}"')
+            emit(f"# Patches to apply\nCOPY *.patch /patches/\n{_run_instruction(patch_commands)}\n")
+
+        if args.run_after:
+            emit("# Commands to run after patching")
+            run_after = args.run_after
+            if patches:
+                # the cd of the patch step ends with it, commands run in the workdir of the last patch.
+                # A cd instead of WORKDIR keeps the image's workdir, ch-image has no final WORKDIR to reset it
+                run_after = [f'cd "{patches[-1][1]}"'] + run_after
+            emit(_run_instruction(run_after))
+            emit()
+
+        workdir = args.docker_workdir or orig_workdir
+        if workdir:
+            emit(f'WORKDIR "{workdir}"')
+        user = args.docker_user or orig_user
+        if user:
+            emit(f'USER "{user}"')
+
+        if args.verbose:
+            print()
+            print(" ------ BEGIN Dockerfile ------ ")
+            print(dockerfile.decode(), end='')
+            print(" ------ END Dockerfile ------ ")
+            print()
 
-            if not diff.strip():
-                print('Error: Diff for git "{}" ref {} is empty!'.format(git_path, git_ref))
-                sys.exit(1)
-
-            add_patch(patch_count, name, diff)
-            patch_count += 1
+        # write files to disk - docker buildx reads the Dockerfile from stdin, so it is
+        # only written for ch-image or to be inspected after a failed build
+        if args.backend == 'ch-image':
+            dockerfs.writebytes('/Dockerfile', bytes(dockerfile))
+        dockerfs.writebytes('/.dockerignore', DOCKERIGNORE)
+
+        # build docker image
+        if args.backend == 'ch-image':
+            build_cmd = ['ch-image', 'build', '-t', fq_tags[0], '-f', str(ctx_root / 'Dockerfile')]
+            if args.no_cache:
+                build_cmd.append('--rebuild')
         else:
-            opt = args.patch.pop(0)
-            for path in opt[:-1]:
-                name = os.path.basename(path)
-                with open(path) as f:
-                    diff = f.read()
-                add_patch(patch_count, name, diff)
-                patch_count += 1
-
-    copy_files = []
-    if args.copy:
-        # copy files to dockerfs
-        for n, (copy_from, copy_to) in enumerate(args.copy):
-            print("Copying {} to docker tempfs".format(copy_from))
-            copy_from = pathlib.Path(copy_from).expanduser()
-            dest_dir = pathlib.Path("copy-{:08d}".format(n))
-            dockerfs.makedir(dest_dir.name)
-            dest_path = pathlib.Path(dockerfs.getsyspath('')) / dest_dir / copy_from.name
-            if copy_from.is_dir():
-                shutil.copytree(copy_from, dest_path)
-            else:
-                shutil.copy(copy_from, dest_path)
-            copy_files.append((str(dest_dir / copy_from.name), copy_to))
-
-    # assert everything has been processed
-    assert not args.git
-    assert not args.patch
-
-    # fetch original values from base image
-    if not args.quiet:
-        print("Pulling {} ...".format(args.base_image))
-    try:
-        client = docker.from_env()
-    except Exception as e:
-        print(f"Error: Could not reach docker daemon - is it running? Error was: {e}")
-        sys.exit(1)
-    try:
-        docker_base_image = client.images.pull(args.base_image)
-    except docker.errors.NotFound as e:
-        print("Error: Could not pull base image - {}".format(e), file=sys.stderr)
-        sys.exit(1)
-
-    orig_user = docker_base_image.attrs['Config'].get('User', '')
-    orig_workdir = docker_base_image.attrs['Config'].get('WorkDir', '/')
-
-    # write docker file
-    dockerfile = []
-    dockerfile.append("FROM {}".format(args.base_image))
-    dockerfile.append("USER root")
-    dockerfile.append("")
-
-    if copy_files:
-        dockerfile.append("# Files or directories to copy into the image")
-        for copy_from, copy_to in copy_files:
-            dockerfile.append("COPY {}".format(json.dumps([copy_from, copy_to])))
-        dockerfile.append('')
-
-    if args.run_before:
-        dockerfile.append("# Commands to run before patching")
-        for command in args.run_before:
-            dockerfile.append('RUN {}'.format(command))
-        dockerfile.append('')
-
-    for patch_name, patch_workdir in patches:
-        print("Adding patch", patch_name)
-        dockerfile.append('# patch {}'.format(patch_name))
-        dockerfile.append('COPY "{}" /'.format(patch_name))
-        dockerfile.append('WORKDIR "{}"'.format(patch_workdir))
-        dockerfile.append('RUN git apply "/{}"'.format(patch_name))
-        dockerfile.append('')
-
-    if args.run_after:
-        dockerfile.append("# Commands to run after patching")
-        for command in args.run_after:
-            dockerfile.append('RUN {}'.format(command))
-        dockerfile.append('')
-
-    workdir = args.docker_workdir or orig_workdir
-    dockerfile.append('WORKDIR "{}"'.format(workdir))
-    user = args.docker_user or orig_user
-    if user:
-        dockerfile.append('USER "{}"'.format(user))
-
-    if args.verbose:
-        print()
-        print(" ------ BEGIN Dockerfile ------ ")
-        print("\n".join(dockerfile))
-        print(" ------ END Dockerfile ------ ")
-        print()
-
-    # write file to disk
-    dockerfs.settext('/Dockerfile', '\n'.join(dockerfile) + '\n')
-
-    # build docker image
-    time_tag = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-    if not args.tags or (args.tag_time and time_tag not in args.tags):
-        args.tags.append(time_tag)
-
-    fq_tags = []
-    for tag in args.tags:
-        fq_tags.append("{}:{}".format(args.repository, tag))
-
-    def print_build_log(build_log):
-        print()
-        print(" --- Docker build log ---")
-        for line in build_log:
-            if 'stream' in line:
-                print(line['stream'], end='')
-
-    print("Building docker image...")
-    build_succeeded = False
-    try:
-        image, log = client.images.build(path=dockerfs.getsyspath(''), tag=fq_tags[0],
-                                         nocache=args.no_cache, network_mode=args.network)
-        build_succeeded = True
-    except docker.errors.BuildError as e:
+            # build with BuildKit via buildx, loading the result into the local image store
+            build_cmd = ['docker', 'buildx', 'build', '--progress=plain', '--load', '-t', fq_tags[0], '-f', '-']
+            if args.no_cache:
+                build_cmd.append('--no-cache')
+            if args.network:
+                build_cmd.extend(['--network', args.network])
+            for cache_from in args.cache_from:
+                build_cmd.extend(['--cache-from', cache_from])
+            if args.cache_to:
+                build_cmd.extend(['--cache-to', args.cache_to])
+            if args.inline_cache:
+                build_cmd.extend(['--build-arg', 'BUILDKIT_INLINE_CACHE=1'])
+                for tag in fq_tags:
+                    build_cmd.extend(['--cache-from', tag])
+        build_cmd.append(str(ctx_root))
+
+        print("Building docker image...")
         if not args.quiet:
-            print_build_log(e.build_log)
             print()
-        print('Error: Build failed! {}'.format(e.msg), file=sys.stderr)
-        print('Leaving docker filesystem intact for you to inspect in {}'
-              ''.format(dockerfs.getsyspath('')), file=sys.stderr)
-        sys.exit(1)
+            print(" --- Docker build log ---")
+        try:
+            proc = subprocess.Popen(build_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, env={**os.environ, 'DOCKER_BUILDKIT': '1'})
+        except FileNotFoundError as e:
+            print("Error: Could not run {} - is it installed? Error was: {}".format(build_cmd[0], e),
+                  file=sys.stderr)
+            sys.exit(1)
+        with proc:
+            try:
+                if args.backend == 'docker':
+                    proc.stdin.write(dockerfile)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            # the build log is shown while building instead of being collected. The pipes
+            # are binary, only the log is decoded as build output may contain any bytes
+            for line in proc.stdout:
+                if not args.quiet:
+                    print(line.decode(errors='replace'), end='', flush=True)
+
+        if proc.returncode != 0:
+            print()
+            print('Error: Build failed! {} exited with code {}'.format(build_cmd[0], proc.returncode),
+                  file=sys.stderr)
+            if args.backend == 'docker':
+                dockerfs.writebytes('/Dockerfile', bytes(dockerfile))
+            print('Leaving docker filesystem intact for you to inspect in {}'
+                  ''.format(ctx_root), file=sys.stderr)
+            keep_context = True
+            sys.exit(1)
     finally:
-        if build_succeeded:
+        if not keep_context:
             dockerfs.clean()
         dockerfs.close()
 
-    if not args.quiet:
-        print_build_log(log)
-
-    # add additional tags to image
-    for tag in args.tags[1:]:
-        image.tag(tag)
+    # add additional tags to image, concurrently as each tag is a separate request to the docker daemon.
+    # Only the first tag is set by the build, the image is referenced by it as buildx's image id is
+    # the config digest, which is not the local image id with the containerd image store
+    if args.tags[1:]:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(args.tags) - 1)) as executor:
+            list(executor.map(lambda tag: client.api.tag(fq_tags[0], args.repository, tag), args.tags[1:]))
 
     # done!
     print()
-    if args.push_image:
+    if args.push_image and args.backend == 'ch-image':
         print("Image successfully built! Will now push the image to the hub")
-        for tag in fq_tags:
-            print()
-            print("Pushing {}".format(tag))
+        print()
+        print("Pushing {}".format(fq_tags[0]))
+        if subprocess.call(['ch-image', 'push', fq_tags[0]]) != 0:
+            print("Error pushing {} to hub".format(fq_tags[0]))
+            sys.exit(1)
+        print("Pushed {} to hub".format(fq_tags[0]))
+    elif args.push_image:
+        print("Image successfully built! Will now push the image to the hub")
+        print_lock = threading.Lock()
+
+        def push(tag):
+            with print_lock:
+                print("Pushing {}".format(tag))
             last_status = "<no status information found>"
             error = False
             for lines in client.images.push(tag, stream=True):
-                lines = lines.strip().decode()
+                lines = lines.strip()
                 if lines:
-                    for line in lines.split("\n"):
-                        data = json.loads(line)
+                    for line in lines.split(b"\n"):
+                        data = json_loads(line)
                         if "error" in data:
                             error = True
-                            print("Error: {}".format(data["error"]))
+                            with print_lock:
+                                print("Error: {}: {}".format(tag, data["error"]))
                         if "status" in data:
                             last_status = data["status"]
-            if not error:
-                print("Pushed {} to hub: {}".format(tag, last_status))
-            else:
-                print("Error pushing {} to hub".format(tag))
-                sys.exit(1)
+            return tag, not error, last_status
+
+        # tags share their blobs, so pushing them concurrently mostly saves registry round-trips
+        print()
+        push_failed = False
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(fq_tags)) as executor:
+            for tag, ok, last_status in executor.map(push, fq_tags):
+                with print_lock:
+                    if ok:
+                        print("Pushed {} to hub: {}".format(tag, last_status))
+                    else:
+                        print("Error pushing {} to hub".format(tag))
+                        push_failed = True
+        if push_failed:
+            sys.exit(1)
     else:
         print("Image successfully built! Docker image can (maybe) be pushed:")
+        push_cmd = 'ch-image push' if args.backend == 'ch-image' else 'docker push'
         for tag in fq_tags:
-            print(" - docker push {}".format(tag))
+            print(" - {} {}".format(push_cmd, tag))
 
 
 if __name__ == '__main__':
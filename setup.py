@@ -12,6 +12,7 @@ setup(
     python_requires='>=3.5',
     packages=['docker_image_patcher'],
     install_requires=['fs', 'docker>=7.1.0', 'requests>=2.32.0'],
+    extras_require={'orjson': ['orjson']},
     classifiers=[
         'Programming Language :: Python :: 3',
         'Environment :: Console',
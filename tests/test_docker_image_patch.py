@@ -0,0 +1,74 @@
+import unittest
+
+from docker_image_patcher.docker_image_patch import (_base_image_defaults, _image_repository, _mirrored_image,
+                                                     _parser, _run_instruction)
+
+
+class ImageRepositoryTest(unittest.TestCase):
+    def test_tag(self):
+        self.assertEqual(_image_repository('python:3.12'), 'python')
+        self.assertEqual(_image_repository('keppel.example.com/ccloud/nova:v1'), 'keppel.example.com/ccloud/nova')
+
+    def test_registry_port(self):
+        self.assertEqual(_image_repository('registry.example.com:5000/foo:v1'), 'registry.example.com:5000/foo')
+        self.assertIsNone(_image_repository('registry.example.com:5000/foo'))
+
+    def test_digest(self):
+        digest = 'sha256:' + 64 * 'a'
+        self.assertEqual(_image_repository('foo@' + digest), 'foo')
+        self.assertEqual(_image_repository('foo:v1@' + digest), 'foo')
+        self.assertEqual(_image_repository('registry.example.com:5000/foo@' + digest), 'registry.example.com:5000/foo')
+
+    def test_no_tag(self):
+        self.assertIsNone(_image_repository('foo'))
+
+
+class BaseImageDefaultsTest(unittest.TestCase):
+    def test_working_dir(self):
+        info = {'Config': {'User': 'app', 'WorkingDir': '/srv'}}
+        self.assertEqual(_base_image_defaults(info), ('app', '/srv'))
+
+    def test_empty_working_dir(self):
+        self.assertEqual(_base_image_defaults({'Config': {'WorkingDir': ''}}), ('', '/'))
+
+    def test_no_config(self):
+        self.assertEqual(_base_image_defaults({'Config': None}), ('', '/'))
+
+
+class MirroredImageTest(unittest.TestCase):
+    def test_official_image(self):
+        self.assertEqual(_mirrored_image('python:3.12', 'mirror.example.com/'),
+                         'mirror.example.com/library/python:3.12')
+
+    def test_docker_hub_namespace(self):
+        self.assertEqual(_mirrored_image('sapcc/nova:v1', 'mirror.example.com'), 'mirror.example.com/sapcc/nova:v1')
+
+    def test_explicit_registry(self):
+        for image in ('registry.example.com/foo:v1', 'registry:5000/foo:v1', 'localhost/foo:v1'):
+            self.assertEqual(_mirrored_image(image, 'mirror.example.com'), image)
+
+
+class RunInstructionTest(unittest.TestCase):
+    def test_chained(self):
+        self.assertEqual(_run_instruction(['apt-get update', 'make']), 'RUN apt-get update && \\\n    make')
+
+    def test_comment_is_confined(self):
+        self.assertEqual(_run_instruction(["apt-get update # it's a refresh", 'make']),
+                         "RUN eval 'apt-get update # it'\"'\"'s a refresh' && \\\n    make")
+
+
+class PatchOrderTest(unittest.TestCase):
+    def test_interleaved_order(self):
+        args = _parser().parse_args(['-b', 'foo:1', '--git=/wd', '-p', 'a.patch', 'b.patch', '/app',
+                                     '-g', 'HEAD~1', '/wd'])
+        self.assertEqual(args.patch_order, [('git', ['/wd']), ('patch', ['a.patch', 'b.patch', '/app']),
+                                            ('git', ['HEAD~1', '/wd'])])
+
+    def test_default_is_not_modified(self):
+        parser = _parser()
+        parser.parse_args(['-b', 'foo:1', '-g', '/wd'])
+        self.assertEqual(parser.parse_args(['-b', 'foo:1']).patch_order, [])
+
+
+if __name__ == '__main__':
+    unittest.main()